@@ -3,32 +3,80 @@ PrometheusAI - Chatbot with Web Search Capabilities and Document Upload
 Flask Application with LM Studio, Web Scraping, and OCR Support
 """
 import os
-import json
+import atexit
 import uuid
 import sys
 import socket
 import re
 import io
 import base64
+import threading
+import tempfile
+import importlib.util
+import queue
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple, Union
 from urllib.parse import urlparse, quote_plus
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from contextlib import contextmanager
+from collections import defaultdict, OrderedDict
 
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
+from selectolax.lexbor import LexborHTMLParser
 from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
+from flask_compress import Compress
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import ValueTarget
 import logging
+import logging.handlers
 
 # PDF and Image processing
 from PIL import Image
 import pytesseract
-import PyPDF2
+import fitz  # PyMuPDF
 import pdf2image
 
-# Configure logging FIRST (before using logger)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Keep each tesseract process single-threaded; pages are OCR'd in parallel instead
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+# In-process Tesseract bindings (optional, falls back to pytesseract)
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Redis chat store (optional, enabled with REDIS_URL)
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# GPU OCR (optional, only used when CUDA is available). torch is installed
+# for the embedding models anyway, so only import it when easyocr is present
+np = torch = easyocr = None
+if importlib.util.find_spec('easyocr') is not None:
+    try:
+        import numpy as np
+        import torch
+        import easyocr
+    except ImportError:
+        np = torch = easyocr = None
+
+# Configure logging FIRST (before using logger). Records are handed to a queue
+# and written by a listener thread, so log I/O never blocks request threads
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Configure Tesseract path for Windows (AFTER logger is defined)
@@ -53,80 +101,393 @@ if os.name == 'nt':  # Windows
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-change-in-production')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Compress JSON and page responses. SSE streams are left alone, since
+# compressing them would buffer deltas instead of sending them as they arrive
+app.config['COMPRESS_MIMETYPES'] = ['application/json', 'text/html', 'text/css', 'application/javascript']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 512
+app.config['COMPRESS_STREAMS'] = False
 CORS(app, supports_credentials=True)
-
-# Persistent storage for chats (only for logged-in users)
-CHAT_SESSIONS_FILE = 'chat_sessions.json'
+Compress(app)
+
+# Persistent storage for chats (only for logged-in users): an append-only JSONL
+# log per chat, plus a metadata log holding titles, timestamps and deletions
+CHAT_SESSIONS_DIR = 'chat_sessions'
+SESSION_METADATA_FILE = os.path.join(CHAT_SESSIONS_DIR, 'session_metadata.jsonl')
+SESSION_METADATA_FIELDS = ('id', 'user_id', 'title', 'created_at', 'updated_at')
+
+# Single-file store used by older versions, migrated on first start
+LEGACY_CHAT_SESSIONS_FILE = 'chat_sessions.json'
+
+# Optional Redis store for chats (e.g. REDIS_URL=unix:///var/run/redis/redis.sock):
+# chat:{id} hash of metadata, chat:{id}:messages list, user:{user_id}:chats sorted set
+REDIS_URL = os.getenv('REDIS_URL')
+redis_client = None
+if REDIS_URL:
+    if redis is None:
+        logger.warning("REDIS_URL is set but the redis package is not installed; using JSONL chat logs")
+    else:
+        redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        logger.info(f"Persisting chats to Redis at {REDIS_URL}")
 
 # In-memory storage for anonymous sessions (not persisted)
 anonymous_sessions = {}
 
-# Upload folder
-UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# Chat ids per user, so listing a user's chats doesn't scan every session
+user_chats = defaultdict(set)
+
+
+# Uploads are read from the request body in large chunks and parsed incrementally
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _session_file(chat_id: str) -> str:
+    """Path of the message log for a chat."""
+    return os.path.join(CHAT_SESSIONS_DIR, f'session_{chat_id}.jsonl')
+
+def _read_jsonl(path: str):
+    """Yield records from a JSONL file, skipping lines torn by a crash mid-write."""
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except ValueError:
+                logger.warning(f"Skipping corrupt line in {path}")
+
+def _append_jsonl(path: str, records: List[Dict]):
+    """Append records to a JSONL file."""
+    with open(path, 'ab') as f:
+        f.write(b''.join(orjson.dumps(record) + b'\n' for record in records))
+
+def _session_metadata(session: Dict) -> Dict:
+    """Pick the persisted metadata fields out of a session."""
+    return {field: session[field] for field in SESSION_METADATA_FIELDS if field in session}
+
+def _metadata_record(session: Dict) -> Dict:
+    """Build the metadata log entry for a session."""
+    return {'type': 'session', **_session_metadata(session)}
+
+def _compact_session_metadata():
+    """Rewrite the metadata log with one entry per live chat."""
+    tmp_path = SESSION_METADATA_FILE + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(orjson.dumps(_metadata_record(session)) + b'\n' for session in chat_sessions.values()))
+    os.replace(tmp_path, SESSION_METADATA_FILE)
+
+def _migrate_legacy_chat_sessions():
+    """Convert the old single JSON file into per-chat logs."""
+    with open(LEGACY_CHAT_SESSIONS_FILE, 'rb') as f:
+        legacy_sessions = orjson.loads(f.read())
+    for chat_id, session in legacy_sessions.items():
+        with open(_session_file(chat_id), 'wb') as f:
+            f.write(b''.join(orjson.dumps({'type': 'message', **msg}) + b'\n' for msg in session.get('messages', [])))
+    chat_sessions.update(legacy_sessions)
+    _compact_session_metadata()
+    os.replace(LEGACY_CHAT_SESSIONS_FILE, LEGACY_CHAT_SESSIONS_FILE + '.migrated')
+    logger.info(f"Migrated {len(legacy_sessions)} chat sessions from {LEGACY_CHAT_SESSIONS_FILE}")
+
+def _load_chat_sessions_from_redis():
+    """Load every user's chats from Redis in one pipelined round trip."""
+    chat_ids = []
+    for user_key in redis_client.scan_iter(match='user:*:chats'):
+        chat_ids.extend(redis_client.zrange(user_key, 0, -1))
+    
+    pipe = redis_client.pipeline(transaction=False)
+    for chat_id in chat_ids:
+        pipe.hgetall(f'chat:{chat_id}')
+        pipe.lrange(f'chat:{chat_id}:messages', 0, -1)
+    results = pipe.execute()
+    
+    for chat_id, metadata, messages in zip(chat_ids, results[::2], results[1::2]):
+        if metadata:
+            chat_sessions[chat_id] = {**metadata, 'messages': [orjson.loads(msg) for msg in messages]}
+    logger.info(f"Loaded {len(chat_sessions)} chat sessions from Redis")
 
 def load_chat_sessions():
     """Load chat sessions from disk."""
     global chat_sessions
-    if os.path.exists(CHAT_SESSIONS_FILE):
-        try:
-            with open(CHAT_SESSIONS_FILE, 'r', encoding='utf-8') as f:
-                chat_sessions = json.load(f)
+    chat_sessions = {}
+    os.makedirs(CHAT_SESSIONS_DIR, exist_ok=True)
+    try:
+        if redis_client is not None:
+            _load_chat_sessions_from_redis()
+        elif os.path.exists(SESSION_METADATA_FILE):
+            # Later entries win; deletions drop the chat entirely
+            for record in _read_jsonl(SESSION_METADATA_FILE):
+                if record.get('type') == 'delete':
+                    chat_sessions.pop(record['id'], None)
+                else:
+                    session = chat_sessions.setdefault(record['id'], {'messages': []})
+                    session.update((field, record[field]) for field in SESSION_METADATA_FIELDS if field in record)
+            
+            for chat_id, session in chat_sessions.items():
+                if os.path.exists(_session_file(chat_id)):
+                    session['messages'] = [
+                        {k: v for k, v in record.items() if k != 'type'}
+                        for record in _read_jsonl(_session_file(chat_id))
+                        if record.get('type') == 'message'
+                    ]
+            
+            _compact_session_metadata()
             logger.info(f"Loaded {len(chat_sessions)} chat sessions from disk")
-        except Exception as e:
-            logger.error(f"Failed to load chat sessions: {e}")
-            chat_sessions = {}
-    else:
+        elif os.path.exists(LEGACY_CHAT_SESSIONS_FILE):
+            _migrate_legacy_chat_sessions()
+    except Exception as e:
+        logger.error(f"Failed to load chat sessions: {e}")
         chat_sessions = {}
-
-def save_chat_sessions():
-    """Save chat sessions to disk (only for logged-in users)."""
+    
+    user_chats.clear()
+    for chat_id, session in chat_sessions.items():
+        user_chats[session.get('user_id')].add(chat_id)
+
+# Chat writes are queued and persisted by a background thread, at most once
+# per CHAT_FLUSH_INTERVAL seconds, so storage I/O stays off the request path
+CHAT_FLUSH_INTERVAL = float(os.getenv('CHAT_FLUSH_INTERVAL', '2.0'))
+_pending_writes = []  # (kind, chat_id, payload) with kind 'message', 'session' or 'delete'
+_pending_lock = threading.Lock()
+_dirty = threading.Event()
+_deleted_chats = set()  # writes still in flight for these chats are dropped
+
+def _queue_writes(writes: List[tuple]):
+    """Queue chat writes for the background flusher."""
+    with _pending_lock:
+        _pending_writes.extend(writes)
+    _dirty.set()
+
+def _flush_to_jsonl(writes: List[tuple]):
+    """Append queued writes to the JSONL chat logs."""
+    # Group records per file (keeping their order) so each file is opened once;
+    # a None batch means the file is removed
+    batches = {}
+    for kind, chat_id, payload in writes:
+        if kind == 'message':
+            records = batches.setdefault(_session_file(chat_id), [])
+            # A removal queued earlier in the batch wins over later messages
+            if records is not None:
+                records.append({'type': 'message', **payload})
+        elif kind == 'session':
+            batches.setdefault(SESSION_METADATA_FILE, []).append({'type': 'session', **payload})
+        else:
+            batches.setdefault(SESSION_METADATA_FILE, []).append({'type': 'delete', 'id': chat_id})
+            batches[_session_file(chat_id)] = None
+    
+    for path, records in batches.items():
+        try:
+            if records is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                _append_jsonl(path, records)
+        except Exception as e:
+            logger.error(f"Failed to save chat sessions to {path}: {e}")
+
+def _flush_to_redis(writes: List[tuple]):
+    """Apply queued writes to Redis in a single pipeline."""
+    pipe = redis_client.pipeline(transaction=False)
+    for kind, chat_id, payload in writes:
+        if kind == 'message':
+            pipe.rpush(f'chat:{chat_id}:messages', orjson.dumps(payload))
+        elif kind == 'session':
+            pipe.hset(f'chat:{chat_id}', mapping=payload)
+            updated_at = datetime.fromisoformat(payload['updated_at']).timestamp()
+            pipe.zadd(f"user:{payload['user_id']}:chats", {chat_id: updated_at})
+        else:
+            pipe.delete(f'chat:{chat_id}', f'chat:{chat_id}:messages')
+            pipe.zrem(f'user:{payload}:chats', chat_id)
     try:
-        with open(CHAT_SESSIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(chat_sessions, f, indent=2, ensure_ascii=False)
-        logger.info(f"Saved {len(chat_sessions)} chat sessions to disk")
+        pipe.execute()
     except Exception as e:
-        logger.error(f"Failed to save chat sessions: {e}")
+        logger.error(f"Failed to save chat sessions to Redis: {e}")
+
+def _coalesce_writes(writes: List[tuple]) -> List[tuple]:
+    """Drop writes for deleted chats and metadata writes superseded by a later one."""
+    writes = [write for write in writes if write[0] == 'delete' or write[1] not in _deleted_chats]
+    last_session = {chat_id: i for i, (kind, chat_id, _) in enumerate(writes) if kind == 'session'}
+    return [write for i, write in enumerate(writes) if write[0] != 'session' or last_session[write[1]] == i]
+
+def flush_chat_sessions():
+    """Persist all queued chat writes."""
+    with _pending_lock:
+        writes = _coalesce_writes(_pending_writes)
+        _pending_writes.clear()
+    if not writes:
+        return
+    
+    if redis_client is not None:
+        _flush_to_redis(writes)
+    else:
+        _flush_to_jsonl(writes)
+
+def _chat_flusher():
+    """Background loop that coalesces queued writes into periodic flushes."""
+    while True:
+        _dirty.wait()
+        time.sleep(CHAT_FLUSH_INTERVAL)
+        _dirty.clear()
+        flush_chat_sessions()
+
+def save_session_metadata(session: Dict):
+    """Record a chat's current title and timestamps."""
+    if session['id'] not in chat_sessions:
+        return
+    _queue_writes([('session', session['id'], _session_metadata(session))])
+
+def save_chat_turn(session: Dict, messages: List[Dict]):
+    """Append new messages to a chat's log and record its updated metadata."""
+    # The chat may have been deleted while its reply was still streaming
+    if session['id'] not in chat_sessions:
+        return
+    _queue_writes([('message', session['id'], dict(msg)) for msg in messages])
+    save_session_metadata(session)
+
+def delete_chat_session(chat_id: str, user_id: str):
+    """Remove a chat's messages and record the deletion."""
+    with _pending_lock:
+        _deleted_chats.add(chat_id)
+    _queue_writes([('delete', chat_id, user_id)])
 
 # Load sessions on startup
 load_chat_sessions()
+threading.Thread(target=_chat_flusher, name='chat-flusher', daemon=True).start()
+atexit.register(flush_chat_sessions)
+
+
+def _open_pdf(source: Union[str, bytes]):
+    """Open a PDF from a file path or from its bytes."""
+    if isinstance(source, bytes):
+        return fitz.open(stream=source, filetype='pdf')
+    return fitz.open(source)
+
+
+@contextmanager
+def _pdf_path(source: Union[str, bytes]):
+    """Yield a file path for a PDF, spooling in-memory PDFs to a temp file."""
+    if not isinstance(source, bytes):
+        yield source
+        return
+    fd, temp_path = tempfile.mkstemp(suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(source)
+        yield temp_path
+    finally:
+        os.remove(temp_path)
 
 
 class DocumentProcessor:
     """Process PDFs and images with OCR capabilities."""
     
+    # Tesseract is tuned for ~30px x-height, so 150 DPI is enough for most documents;
+    # pages that come back with low confidence are re-rendered at the higher DPI
+    OCR_DPI = 150
+    OCR_RETRY_DPI = 200
+    OCR_MIN_CONFIDENCE = 70
+    
+    # Batched GPU inference only pays off once there are enough pages to fill a batch
+    GPU_BATCH_SIZE = 8
+    
+    # Leading bytes of each accepted format, checked before any expensive processing
+    PDF_SIGNATURE = b'%PDF'
+    IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'BM')
+    
+    # Larger images are downscaled before OCR to bound Tesseract's work
+    MAX_OCR_IMAGE_DIMENSION = 6000
+    OCR_IMAGE_THUMBNAIL_SIZE = (4000, 4000)
+    
     def __init__(self):
         """Initialize the document processor."""
+        # Prefer EasyOCR on the GPU when CUDA is available
+        self.gpu_reader = None
+        self._gpu_lock = threading.Lock()
+        if easyocr is not None and torch.cuda.is_available():
+            try:
+                self.gpu_reader = easyocr.Reader(['en'], gpu=True, cudnn_benchmark=True)
+                # Warm up so the first upload doesn't pay for CUDA kernel selection
+                self.gpu_reader.readtext(np.zeros((64, 256), dtype=np.uint8), detail=0)
+                logger.info("EasyOCR GPU reader initialized")
+            except Exception as e:
+                self.gpu_reader = None
+                logger.warning(f"EasyOCR GPU reader not usable, falling back to Tesseract: {e}")
+        
+        # Otherwise prefer in-process tesserocr, which keeps the language model loaded between calls
+        self.use_tesserocr = False
+        if self.gpu_reader is None and tesserocr is not None:
+            try:
+                logger.info(f"tesserocr available (Tesseract {tesserocr.tesseract_version().splitlines()[0]})")
+                self.use_tesserocr = True
+            except Exception as e:
+                logger.warning(f"tesserocr not usable, falling back to pytesseract: {e}")
+        
         # Check if tesseract is available
-        try:
-            pytesseract.get_tesseract_version()
+        if self.gpu_reader is not None or self.use_tesserocr:
             self.ocr_available = True
-            logger.info("Tesseract OCR is available")
-        except Exception as e:
-            self.ocr_available = False
-            logger.warning(f"Tesseract OCR not available: {e}")
+        else:
+            try:
+                pytesseract.get_tesseract_version()
+                self.ocr_available = True
+                logger.info("Tesseract OCR is available")
+            except Exception as e:
+                self.ocr_available = False
+                logger.warning(f"Tesseract OCR not available: {e}")
+        
+        # Long-lived OCR threads, each holding its own tesserocr API (not thread-safe)
+        self._tess_local = threading.local()
+        self.ocr_workers = max(1, int(os.getenv('OCR_WORKERS', os.cpu_count() or 1)))
+        self._ocr_executor = ThreadPoolExecutor(max_workers=self.ocr_workers, thread_name_prefix='ocr')
+    
+    def _get_tess_api(self):
+        """Get the tesserocr API for the current thread, creating it on first use."""
+        api = getattr(self._tess_local, 'api', None)
+        if api is None:
+            api = tesserocr.PyTessBaseAPI(lang='eng')
+            self._tess_local.api = api
+        return api
+    
+    def _ocr_image(self, image: Image.Image) -> str:
+        """Run OCR on a single PIL image."""
+        # Tesseract binarizes internally, so colour only adds bytes to move around
+        if image.mode != 'L':
+            image = image.convert('L')
+        
+        if self.gpu_reader is not None:
+            with self._gpu_lock:
+                return '\n'.join(self.gpu_reader.readtext(np.asarray(image), detail=0, paragraph=True))
+        
+        if self.use_tesserocr:
+            # Hand the raw 8-bit buffer to leptonica instead of re-encoding the image
+            api = self._get_tess_api()
+            api.SetImageBytes(image.tobytes(), image.width, image.height, 1, image.width)
+            return api.GetUTF8Text()
+        return pytesseract.image_to_string(image)
     
-    def extract_text_from_pdf(self, file_path: str) -> Dict[str, any]:
-        """Extract text from PDF, fallback to OCR if needed."""
+    def extract_text_from_pdf(self, source: Union[str, bytes]) -> Dict[str, any]:
+        """Extract text from a PDF path or bytes, fallback to OCR if needed."""
         try:
-            text = ""
             pages = 0
             
             # Try extracting text directly
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                pages = len(pdf_reader.pages)
+            with _open_pdf(source) as pdf_doc:
+                pages = pdf_doc.page_count
                 
-                for page_num, page in enumerate(pdf_reader.pages):
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += f"\n--- Page {page_num + 1} ---\n{page_text}"
+                if self.ocr_available and pages and self._is_scanned_page(pdf_doc[0]):
+                    # Scanned documents have no text layer, so skip the full extraction pass
+                    logger.info("PDF appears to be scanned, skipping direct text extraction")
+                    page_texts = []
+                else:
+                    page_texts = [page.get_text() for page in pdf_doc]
+            
+            parts = []
+            for page_num, page_text in enumerate(page_texts):
+                if page_text:
+                    parts.append(f"\n--- Page {page_num + 1} ---\n{page_text}")
+            text = ''.join(parts)
             
             # If no text extracted and OCR is available, try OCR
             if not text.strip() and self.ocr_available:
                 logger.info("No text found in PDF, attempting OCR...")
-                text = self.ocr_pdf(file_path)
+                text = self.ocr_pdf(source)
                 
             return {
                 'success': True,
@@ -142,16 +503,28 @@ class DocumentProcessor:
                 'error': str(e)
             }
     
-    def ocr_pdf(self, file_path: str, max_pages: int = 10) -> str:
+    def _is_scanned_page(self, page) -> bool:
+        """Check whether a PDF page is only an image, with no font-backed text."""
+        if page.get_fonts() or not page.get_images():
+            return False
+        return len(page.get_text().strip()) < 20
+    
+    def ocr_pdf(self, file_path: Union[str, bytes], max_pages: int = 10) -> str:
         """Perform OCR on PDF pages."""
+        if isinstance(file_path, bytes):
+            # Poppler only reads files, so in-memory PDFs are spooled to disk for OCR
+            with _pdf_path(file_path) as temp_path:
+                return self.ocr_pdf(temp_path, max_pages)
+        
         try:
             # For Windows, you may need to specify poppler path
             # Download poppler from: https://github.com/oschwartz10612/poppler-windows/releases/
             # Extract and set path, e.g.: poppler_path = r'C:\path\to\poppler\bin'
             
+            poppler_path = None
             try:
                 # Try without poppler path first (if it's in PATH)
-                images = pdf2image.convert_from_path(file_path, dpi=200)
+                pdf_info = pdf2image.pdfinfo_from_path(file_path)
             except Exception as e:
                 logger.warning(f"pdf2image failed without poppler path: {e}")
                 # Try common Windows poppler locations
@@ -161,27 +534,44 @@ class DocumentProcessor:
                     r'C:\Program Files (x86)\poppler\bin'
                 ]
                 
-                images = None
-                for poppler_path in poppler_paths:
-                    if os.path.exists(poppler_path):
+                pdf_info = None
+                for candidate in poppler_paths:
+                    if os.path.exists(candidate):
                         try:
-                            images = pdf2image.convert_from_path(file_path, dpi=200, poppler_path=poppler_path)
+                            pdf_info = pdf2image.pdfinfo_from_path(file_path, poppler_path=candidate)
+                            poppler_path = candidate
                             logger.info(f"Using poppler from: {poppler_path}")
                             break
                         except:
                             continue
                 
-                if images is None:
+                if pdf_info is None:
                     return "[OCR Error: Poppler not found. Please install poppler-utils for PDF OCR. See: https://github.com/oschwartz10612/poppler-windows/releases/]"
             
-            text = ""
-            for i, image in enumerate(images[:max_pages]):
-                logger.info(f"OCR processing page {i + 1}...")
-                page_text = pytesseract.image_to_string(image)
-                text += f"\n--- Page {i + 1} (OCR) ---\n{page_text}"
+            total_pages = pdf_info['Pages']
+            pages_to_ocr = min(total_pages, max_pages)
+            logger.info(f"OCR processing {pages_to_ocr} pages...")
             
-            if len(images) > max_pages:
-                text += f"\n\n[Note: Only processed first {max_pages} pages of {len(images)} total pages]"
+            if self.gpu_reader is not None and pages_to_ocr >= self.GPU_BATCH_SIZE:
+                page_texts = self._ocr_pdf_gpu_batch(file_path, pages_to_ocr, poppler_path)
+            elif self.ocr_workers == 1 and self.gpu_reader is None and not self.use_tesserocr:
+                # No parallelism: one tesseract run for all pages amortizes its startup cost
+                page_texts = self._ocr_pdf_batch(file_path, pages_to_ocr, poppler_path)
+            else:
+                # Each page is rendered just before it is OCR'd, so only one bitmap per worker is alive
+                futures = [
+                    self._ocr_executor.submit(self._ocr_pdf_page, file_path, page_num, poppler_path)
+                    for page_num in range(1, pages_to_ocr + 1)
+                ]
+                page_texts = [future.result() for future in futures]
+            
+            text = ''.join(
+                f"\n--- Page {page_num} (OCR) ---\n{page_text}"
+                for page_num, page_text in enumerate(page_texts, 1)
+            )
+            
+            if total_pages > max_pages:
+                text += f"\n\n[Note: Only processed first {max_pages} pages of {total_pages} total pages]"
             
             return text
             
@@ -189,8 +579,90 @@ class DocumentProcessor:
             logger.error(f"Error performing OCR on PDF: {e}")
             return f"[OCR Error: {str(e)}]"
     
-    def extract_text_from_image(self, file_path: str) -> Dict[str, any]:
-        """Extract text from image using OCR."""
+    def _ocr_pdf_page(self, file_path: str, page_num: int, poppler_path: Optional[str] = None,
+                      dpi: int = OCR_DPI) -> str:
+        """Render a single PDF page and OCR it, releasing the bitmap straight after."""
+        images = pdf2image.convert_from_path(
+            file_path,
+            dpi=dpi,
+            first_page=page_num,
+            last_page=page_num,
+            grayscale=True,
+            poppler_path=poppler_path
+        )
+        try:
+            text = ''.join(self._ocr_image(image) for image in images)
+        finally:
+            for image in images:
+                image.close()
+        
+        # tesserocr reports confidence for free; small print may need the extra resolution.
+        # Blank pages score 0 but have nothing to recover, so only retry pages with text
+        if self.use_tesserocr and dpi < self.OCR_RETRY_DPI and text.strip():
+            confidence = self._get_tess_api().MeanTextConf()
+            if confidence < self.OCR_MIN_CONFIDENCE:
+                logger.info(f"Low OCR confidence ({confidence}) on page {page_num}, retrying at {self.OCR_RETRY_DPI} DPI")
+                return self._ocr_pdf_page(file_path, page_num, poppler_path, dpi=self.OCR_RETRY_DPI)
+        
+        return text
+    
+    def _ocr_pdf_gpu_batch(self, file_path: str, page_count: int, poppler_path: Optional[str] = None) -> List[str]:
+        """OCR the first page_count pages in batches on the GPU."""
+        images = pdf2image.convert_from_path(
+            file_path,
+            dpi=self.OCR_DPI,
+            first_page=1,
+            last_page=page_count,
+            grayscale=True,
+            poppler_path=poppler_path
+        )
+        try:
+            arrays = [np.asarray(image) for image in images]
+        finally:
+            for image in images:
+                image.close()
+        
+        # EasyOCR resizes every page to the same shape so they can be stacked into batches
+        with self._gpu_lock:
+            results = self.gpu_reader.readtext_batched(
+                arrays,
+                n_width=1024,
+                n_height=1400,
+                batch_size=self.GPU_BATCH_SIZE,
+                detail=0,
+                paragraph=True
+            )
+        return ['\n'.join(lines) for lines in results]
+    
+    def _ocr_pdf_batch(self, file_path: str, page_count: int, poppler_path: Optional[str] = None) -> List[str]:
+        """OCR the first page_count pages with a single tesseract invocation."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            image_paths = pdf2image.convert_from_path(
+                file_path,
+                dpi=self.OCR_DPI,
+                first_page=1,
+                last_page=page_count,
+                grayscale=True,
+                output_folder=temp_dir,
+                paths_only=True,
+                fmt='png',
+                poppler_path=poppler_path
+            )
+            
+            # Tesseract treats a text file as a list of images, one path per line
+            list_path = os.path.join(temp_dir, 'images.txt')
+            with open(list_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(image_paths))
+            
+            output = pytesseract.image_to_string(list_path)
+        
+        # Pages are separated by form feeds
+        page_texts = output.split('\x0c')[:len(image_paths)]
+        page_texts += [''] * (len(image_paths) - len(page_texts))
+        return page_texts
+    
+    def extract_text_from_image(self, source: Union[str, io.BytesIO]) -> Dict[str, any]:
+        """Extract text from an image path or file object using OCR."""
         try:
             if not self.ocr_available:
                 return {
@@ -198,15 +670,12 @@ class DocumentProcessor:
                     'error': 'OCR is not available. Please install Tesseract.'
                 }
             
-            # Open and process image
-            image = Image.open(file_path)
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Perform OCR
-            text = pytesseract.image_to_string(image)
+            # Perform OCR (on an OCR thread so its tesserocr API is reused)
+            with Image.open(source) as image:
+                if max(image.size) > self.MAX_OCR_IMAGE_DIMENSION:
+                    logger.info(f"Downscaling {image.size[0]}x{image.size[1]} image before OCR")
+                    image.thumbnail(self.OCR_IMAGE_THUMBNAIL_SIZE)
+                text = self._ocr_executor.submit(self._ocr_image, image).result()
             
             return {
                 'success': True,
@@ -221,17 +690,63 @@ class DocumentProcessor:
                 'error': str(e)
             }
     
-    def process_file(self, file_path: str, file_type: str) -> Dict[str, any]:
-        """Process file based on type."""
+    def _has_valid_signature(self, header: bytes, file_type: str) -> bool:
+        """Check a file's leading bytes match its declared type."""
         if file_type == 'pdf':
-            return self.extract_text_from_pdf(file_path)
-        elif file_type in ['image', 'jpg', 'jpeg', 'png', 'gif', 'bmp']:
-            return self.extract_text_from_image(file_path)
-        else:
+            # The spec allows a little junk before the %PDF marker
+            return self.PDF_SIGNATURE in header
+        return header.startswith(self.IMAGE_SIGNATURES)
+    
+    def process_stream(self, data: bytes, file_type: str) -> Dict[str, any]:
+        """Process an in-memory file based on type."""
+        if file_type not in ['pdf', 'image', 'jpg', 'jpeg', 'png', 'gif', 'bmp']:
             return {
                 'success': False,
-                'error': f'Unsupported file type: {file_type}'
+                'error': f'Unsupported file type: {file_type}',
+                'status': 415
             }
+        
+        if not self._has_valid_signature(data[:1024], file_type):
+            return {
+                'success': False,
+                'error': f'File content does not match its type ({file_type})',
+                'status': 415
+            }
+        
+        if file_type == 'pdf':
+            return self.extract_text_from_pdf(data)
+        else:
+            return self.extract_text_from_image(io.BytesIO(data))
+
+
+# Search result pages are cached per process; the TTL bucket rolls over every WEB_CACHE_TTL seconds
+WEB_CACHE_TTL = 300
+
+# Scraped pages aren't cached and only this much of each body is read
+MAX_SCRAPE_BYTES = 2 * 1024 * 1024
+
+# Complete search_and_scrape results kept per normalized query for WEB_CACHE_TTL seconds
+SEARCH_CACHE_SIZE = 1024
+
+# Time and date questions always get a live search, never a cached answer
+TIME_QUERY_RE = re.compile(r'\b(?:time|date|today|now|current|currently)\b')
+
+
+@lru_cache(maxsize=256)
+def _fetch_url(session: requests.Session, url: str, timeout: int, ttl_bucket: int) -> bytes:
+    """Fetch a URL body. Raises on non-200 responses so failures are never cached."""
+    response = session.get(url, timeout=timeout)
+    if response.status_code != 200:
+        raise requests.HTTPError(f"HTTP {response.status_code} for {url}", response=response)
+    return response.content
+
+
+# Result containers on each engine's page; everything outside them is skipped while parsing
+BRAVE_RESULT_STRAINER = SoupStrainer('div', class_='snippet fdb')
+# Strainers compare class_ with the whole class attribute, so multi-class containers
+# (e.g. class="g tF2Cxc") are matched on a single class token instead
+BING_RESULT_STRAINER = SoupStrainer('li', class_=re.compile(r'(?:^|\s)b_algo(?:\s|$)'))
+GOOGLE_RESULT_STRAINER = SoupStrainer('div', class_=re.compile(r'(?:^|\s)g(?:\s|$)'))
 
 
 class WebSearcher:
@@ -244,16 +759,36 @@ class WebSearcher:
         }
         self.session = requests.Session()
         self.session.headers.update(self.headers)
+        
+        # (query, num_urls, max_chars) -> (expires_at, result), in insertion (= expiry) order
+        self._results_cache = OrderedDict()
+        self._results_lock = threading.Lock()
+    
+    def fetch(self, url: str, timeout: int = 10) -> bytes:
+        """Fetch a URL body, reusing a cached copy younger than WEB_CACHE_TTL."""
+        return _fetch_url(self.session, url, timeout, int(time.time() // WEB_CACHE_TTL))
+    
+    def fetch_page(self, url: str, timeout: int = 15) -> bytes:
+        """Fetch a text/HTML page for scraping, reading at most MAX_SCRAPE_BYTES of it."""
+        with self.session.get(url, timeout=timeout, stream=True) as response:
+            if response.status_code != 200:
+                raise requests.HTTPError(f"HTTP {response.status_code} for {url}", response=response)
+            content_type = response.headers.get('Content-Type', '')
+            if not content_type.startswith('text/') and 'xhtml' not in content_type:
+                raise ValueError(f"Not a text page ({content_type or 'unknown type'}): {url}")
+            
+            body = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                body += chunk
+                if len(body) >= MAX_SCRAPE_BYTES:
+                    break
+            return bytes(body[:MAX_SCRAPE_BYTES])
 
     def search_brave(self, query: str, num_results: int = 5) -> List[Dict[str, str]]:
         try:
             search_url = f"https://search.brave.com/search?q={quote_plus(query)}"
-            response = self.session.get(search_url, timeout=10)
-            if response.status_code != 200:
-                logger.error(f"Brave search failed with status {response.status_code}")
-                return []
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
+            html = self.fetch(search_url, timeout=10)
+            soup = BeautifulSoup(html, 'lxml', parse_only=BRAVE_RESULT_STRAINER)
             results = []
             
             for result in soup.find_all('div', class_='snippet fdb')[:num_results]:
@@ -281,17 +816,14 @@ class WebSearcher:
 
     def search_html_fallback(self, query: str, num_results: int = 5) -> List[Dict[str, str]]:
         search_engines = [
-            {'url': f"https://www.bing.com/search?q={quote_plus(query)}", 'type': 'bing'},
-            {'url': f"https://www.google.com/search?q={quote_plus(query)}", 'type': 'google'},
+            {'url': f"https://www.bing.com/search?q={quote_plus(query)}", 'type': 'bing', 'strainer': BING_RESULT_STRAINER},
+            {'url': f"https://www.google.com/search?q={quote_plus(query)}", 'type': 'google', 'strainer': GOOGLE_RESULT_STRAINER},
         ]
         
         for engine in search_engines:
             try:
-                response = self.session.get(engine['url'], timeout=10)
-                if response.status_code != 200:
-                    continue
-                
-                soup = BeautifulSoup(response.text, 'html.parser')
+                html = self.fetch(engine['url'], timeout=10)
+                soup = BeautifulSoup(html, 'lxml', parse_only=engine['strainer'])
                 results = []
                 
                 if engine['type'] == 'bing':
@@ -349,18 +881,13 @@ class WebSearcher:
         """Scrape content from a URL."""
         try:
             logger.info(f"Scraping URL: {url}")
-            response = self.session.get(url, timeout=15)
-            
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch URL: {response.status_code}")
-                return None
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
+            html = self.fetch_page(url, timeout=15)
+            tree = LexborHTMLParser(html)
             
-            for script in soup(['script', 'style', 'nav', 'footer', 'header']):
-                script.decompose()
+            for node in tree.css('script, style, nav, footer, header'):
+                node.decompose()
             
-            text = soup.get_text()
+            text = tree.body.text() if tree.body else ''
             lines = (line.strip() for line in text.splitlines())
             chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
             text = ' '.join(chunk for chunk in chunks if chunk)
@@ -375,19 +902,58 @@ class WebSearcher:
             logger.error(f"Error scraping URL {url}: {e}")
             return None
     
-    def search_and_scrape(self, query: str, num_urls: int = 3) -> Dict[str, any]:
-        """Search and scrape top results."""
+    def search_and_scrape(self, query: str, num_urls: int = 3, max_chars: int = 5000) -> Dict[str, any]:
+        """Search and scrape top results, reusing results for the same query younger than WEB_CACHE_TTL."""
+        normalized_query = ' '.join(query.lower().split())
+        if TIME_QUERY_RE.search(normalized_query):
+            return self._search_and_scrape(normalized_query, num_urls, max_chars)[0]
+        
+        key = (normalized_query, num_urls, max_chars)
+        with self._results_lock:
+            cached = self._results_cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+        
+        result, complete = self._search_and_scrape(normalized_query, num_urls, max_chars)
+        # Failed searches and snippet fallbacks (usually transient fetch errors) aren't cached
+        if complete:
+            now = time.monotonic()
+            with self._results_lock:
+                self._results_cache.pop(key, None)
+                self._results_cache[key] = (now + WEB_CACHE_TTL, result)
+                while self._results_cache and (
+                    len(self._results_cache) > SEARCH_CACHE_SIZE
+                    or next(iter(self._results_cache.values()))[0] <= now
+                ):
+                    self._results_cache.popitem(last=False)
+        return result
+    
+    def _search_and_scrape(self, query: str, num_urls: int, max_chars: int) -> Tuple[Dict[str, any], bool]:
+        """Search and scrape top results, keeping at most max_chars of each page.
+        
+        Returns the result and whether every page was scraped successfully.
+        """
         search_results = self.search_google(query, num_results=num_urls)
         
         if not search_results:
             return {
                 'success': False,
                 'error': 'No search results found'
-            }
+            }, False
+        
+        top_results = search_results[:num_urls]
+        
+        # Scrapes are pure network waits, so fetch them concurrently
+        contents = []
+        if top_results:
+            with ThreadPoolExecutor(max_workers=len(top_results)) as executor:
+                contents = list(executor.map(
+                    lambda url: self.scrape_url(url, max_chars=max_chars),
+                    [result['url'] for result in top_results]
+                ))
         
         scraped_data = []
-        for result in search_results[:num_urls]:
-            content = self.scrape_url(result['url'])
+        for result, content in zip(top_results, contents):
             if content:
                 scraped_data.append({
                     'title': result['title'],
@@ -407,7 +973,90 @@ class WebSearcher:
             'success': True,
             'query': query,
             'results': scraped_data
-        }
+        }, all(contents)
+
+
+# Substrings of a (lowercased) query that trigger a web search
+SEARCH_TRIGGER_KEYWORDS = [
+    # Time and date
+    'time', 'date', 'today', 'now', 'right now', 'currently', 'what time',
+    # Education
+    'university', 'college', 'school', 'courses', 'programs',
+    # General lookups
+    'latest', 'current', 'recent', 'news', 'courses at',
+    'programs at', 'what are the', 'list', 'find', 'search',
+    'website', 'url', 'information about', 'details about',
+    'what is the date', 'what is the time', 'what time is it'
+]
+
+# One alternation scans the query once instead of once per keyword
+SEARCH_TRIGGER_RE = re.compile('|'.join(map(re.escape, SEARCH_TRIGGER_KEYWORDS)))
+
+
+# Replacement characters and anything outside the Basic Multilingual Plane (emoji etc.)
+UNWANTED_CHARS_RE = re.compile('[\ufffd\U00010000-\U0010ffff]')
+
+
+# Streamed LM Studio output is flushed once this many characters are buffered,
+# or once this many seconds have passed since the last flush
+STREAM_FLUSH_CHARS = 32
+STREAM_FLUSH_INTERVAL = 0.05
+
+# SSE frames sent to the browser are batched into one write per this many
+# bytes or seconds
+SSE_FLUSH_BYTES = 1024
+SSE_FLUSH_INTERVAL = 0.03
+
+
+def _sse_frame(payload: Dict) -> bytes:
+    """Encode a payload as a server-sent event frame."""
+    return b'data: ' + orjson.dumps(payload) + b'\n\n'
+
+
+# Characters of each scraped page passed to the model as web context
+CONTEXT_CHARS_PER_SOURCE = 1500
+
+
+# System prompts are constant, so the system message is built once and shared
+CHAT_SYSTEM_PROMPT = (
+    "You are PrometheusAI, a helpful and friendly AI assistant built by SamCodeMan's LLC. "
+    "You provide accurate, helpful, and conversational responses. "
+    
+    "CRITICAL INSTRUCTION: If the user asks about current time, date, or 'right now' information, "
+    "you MUST use the web search results provided. DO NOT use your internal knowledge for time-sensitive queries. "
+    "Your training data is outdated for current information. Always rely on web search results when provided. "
+    
+    "When web search results are provided, use them to answer the user's question accurately. "
+    "Always cite your sources by mentioning the website or URL when using web information. "
+    
+    "When document content is provided (from uploaded PDFs or images), use that information to answer questions accurately. "
+    "Reference the document when providing answers based on its content. "
+    
+    "If web search results or document content don't contain the exact answer, acknowledge this and provide the best answer you can. "
+    "Be concise but informative, and maintain a friendly tone. "
+    "Do not use emojis or special characters in your responses."
+)
+CHAT_SYSTEM_MSG = {"role": "system", "content": CHAT_SYSTEM_PROMPT}
+
+STREAM_SYSTEM_PROMPT = (
+    "You are PrometheusAI, a helpful and friendly AI assistant built by SamCodeMan LLC. "
+    "You provide accurate, helpful, and conversational responses. "
+    
+    "CRITICAL INSTRUCTION: If the user asks about current time, date, or 'right now' information, "
+    "you MUST use the web search results provided. DO NOT use your internal knowledge for time-sensitive queries. "
+    "Your training data is outdated for current information. Always rely on web search results when provided. "
+    
+    "When web search results are provided, use them to answer the user's question accurately. "
+    "Always cite your sources by mentioning the website or URL when using web information. "
+    
+    "When document content is provided (from uploaded PDFs or images), use that information to answer questions accurately. "
+    "Reference the document when providing answers based on its content. "
+    
+    "If web search results or document content don't contain the exact answer, acknowledge this and suggest the user visit the source directly. "
+    "Be concise but informative, and maintain a friendly tone. "
+    "Do not use emojis or special characters in your responses."
+)
+STREAM_SYSTEM_MSG = {"role": "system", "content": STREAM_SYSTEM_PROMPT}
 
 
 class SimpleChatbot:
@@ -421,6 +1070,12 @@ class SimpleChatbot:
         """Initialize the chatbot."""
         self.lm_studio_url = lm_studio_url
         self.model_name = model_name
+        
+        # Keep-alive connections to LM Studio, reused across chat turns
+        self.lm_session = requests.Session()
+        self.lm_session.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=10))
+        self.lm_session.headers['Content-Type'] = 'application/json'
+        
         self.web_searcher = WebSearcher()
         self.doc_processor = DocumentProcessor()
         logger.info("Chatbot initialized with web search and document processing capabilities!")
@@ -430,31 +1085,11 @@ class SimpleChatbot:
         if not text:
             return ""
         
-        cleaned = text.replace('\ufffd', '')
-        cleaned = ''.join(char for char in cleaned if ord(char) < 0x10000)
-        
-        return cleaned
+        return UNWANTED_CHARS_RE.sub('', text)
     
     def should_search_web(self, query: str) -> bool:
         """Determine if the query requires web search."""
-        search_indicators = [
-            'latest', 'current', 'recent', 'today', 'news', 'courses at',
-            'programs at', 'what are the', 'list', 'find', 'search',
-            'website', 'url', 'information about', 'details about',
-            'time', 'date', 'now', 'right now', 'currently',
-            'what is the date', 'what is the time', 'what time is it'
-        ]
-        
-        query_lower = query.lower()
-        
-        time_date_keywords = ['time', 'date', 'today', 'now', 'right now', 'currently', 'what time']
-        if any(keyword in query_lower for keyword in time_date_keywords):
-            return True
-        
-        if any(term in query_lower for term in ['university', 'college', 'school', 'courses', 'programs']):
-            return True
-        
-        return any(indicator in query_lower for indicator in search_indicators)
+        return SEARCH_TRIGGER_RE.search(query.lower()) is not None
     
     def extract_search_query(self, user_query: str) -> str:
         """Extract a good search query from user's question."""
@@ -492,17 +1127,16 @@ class SimpleChatbot:
         
         try:
             logger.info(f"Sending request to LM Studio (model: {self.model_name})")
-            response = requests.post(
+            response = self.lm_session.post(
                 self.lm_studio_url,
-                headers={"Content-Type": "application/json"},
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=60
             )
 
             if not response.ok:
                 body_text = None
                 try:
-                    body_json = response.json()
+                    body_json = orjson.loads(response.content)
                     body_text = body_json.get('error', {}).get('message') or str(body_json)
                 except Exception:
                     body_text = response.text
@@ -520,21 +1154,20 @@ class SimpleChatbot:
                                 logger.info(f"Retrying with fallback model '{chosen}'")
                                 self.model_name = chosen
                                 retry_payload = {**payload, 'model': self.model_name}
-                                retry_resp = requests.post(
+                                retry_resp = self.lm_session.post(
                                     self.lm_studio_url,
-                                    headers={"Content-Type": "application/json"},
-                                    json=retry_payload,
+                                    data=orjson.dumps(retry_payload),
                                     timeout=60
                                 )
                                 if retry_resp.ok:
-                                    result = retry_resp.json()['choices'][0]['message']['content']
+                                    result = orjson.loads(retry_resp.content)['choices'][0]['message']['content']
                                     return self.clean_text(result)
                     except Exception as e:
                         logger.error(f"Error during fallback: {e}")
                 
                 return "Sorry, the language model returned an error. Please check that LM Studio is running and a model is loaded."
 
-            result = response.json()
+            result = orjson.loads(response.content)
             content = result['choices'][0]['message']['content']
             return self.clean_text(content)
 
@@ -560,10 +1193,9 @@ class SimpleChatbot:
 
         try:
             logger.info(f"Sending streaming request to LM Studio (model: {self.model_name})")
-            resp = requests.post(
+            resp = self.lm_session.post(
                 self.lm_studio_url,
-                headers={"Content-Type": "application/json"},
-                json=payload,
+                data=orjson.dumps(payload),
                 stream=True,
                 timeout=timeout
             )
@@ -576,40 +1208,59 @@ class SimpleChatbot:
                 yield f"[ERROR] {body}"
                 return
 
-            for raw_line in resp.iter_lines(decode_unicode=True):
-                if raw_line is None:
-                    continue
-                line = raw_line.strip()
-                if not line:
-                    continue
+            # Small deltas are coalesced so callers get ~20-30 chunks a second rather than one per token
+            buffer = []
+            buffered_chars = 0
+            last_flush = time.monotonic()
+            
+            try:
+                # Lines stay as bytes; orjson parses them without a decode step
+                for raw_line in resp.iter_lines():
+                    if raw_line is None:
+                        continue
+                    line = raw_line.strip()
+                    if not line:
+                        continue
 
-                if line.startswith('data:'):
-                    line = line[len('data:'):].strip()
+                    if line.startswith(b'data:'):
+                        line = line[len(b'data:'):].strip()
 
-                if line == '[DONE]':
-                    break
+                    if line == b'[DONE]':
+                        break
 
-                try:
-                    obj = json.loads(line)
-                    choices = obj.get('choices') if isinstance(obj, dict) else None
-                    if choices:
+                    try:
+                        obj = orjson.loads(line)
+                        choices = obj.get('choices') if isinstance(obj, dict) else None
+                        if not choices:
+                            continue
                         ch = choices[0]
                         delta = ch.get('delta', {})
                         if isinstance(delta, dict) and 'content' in delta:
                             content = delta.get('content')
-                            if content:
-                                clean_content = self.clean_text(content)
-                                if clean_content:
-                                    yield clean_content
                         elif ch.get('message'):
-                            msg_content = ch['message'].get('content')
-                            if msg_content:
-                                clean_content = self.clean_text(msg_content)
-                                if clean_content:
-                                    yield clean_content
-                except Exception as e:
-                    logger.error(f"Error parsing stream chunk: {e}")
-                    continue
+                            content = ch['message'].get('content')
+                        else:
+                            content = None
+                    except Exception as e:
+                        logger.error(f"Error parsing stream chunk: {e}")
+                        continue
+
+                    if content:
+                        buffer.append(content)
+                        buffered_chars += len(content)
+                        if buffered_chars >= STREAM_FLUSH_CHARS or time.monotonic() - last_flush > STREAM_FLUSH_INTERVAL:
+                            clean_content = self.clean_text(''.join(buffer))
+                            buffer.clear()
+                            buffered_chars = 0
+                            last_flush = time.monotonic()
+                            if clean_content:
+                                yield clean_content
+            finally:
+                resp.close()
+
+            clean_content = self.clean_text(''.join(buffer))
+            if clean_content:
+                yield clean_content
 
         except requests.exceptions.RequestException as e:
             yield f"[ERROR] Error querying LM Studio: {e}"
@@ -629,37 +1280,19 @@ class SimpleChatbot:
             logger.info("Web search triggered for query")
             search_query = self.extract_search_query(user_query)
             
-            web_data = self.web_searcher.search_and_scrape(search_query, num_urls=2)
+            web_data = self.web_searcher.search_and_scrape(search_query, num_urls=2, max_chars=CONTEXT_CHARS_PER_SOURCE)
             
             if web_data['success'] and web_data['results']:
-                web_context = "\n\nWeb Search Results:\n"
+                parts = ["\n\nWeb Search Results:\n"]
                 for idx, result in enumerate(web_data['results'], 1):
-                    web_context += f"\n[Source {idx}] {result['title']}\n"
-                    web_context += f"URL: {result['url']}\n"
-                    web_context += f"Content: {result['content'][:1500]}...\n"
+                    parts.append(f"\n[Source {idx}] {result['title']}\n")
+                    parts.append(f"URL: {result['url']}\n")
+                    parts.append(f"Content: {result['content'][:CONTEXT_CHARS_PER_SOURCE]}...\n")
+                web_context = ''.join(parts)
                 
                 logger.info(f"Added web context from {len(web_data['results'])} sources")
         
-        system_prompt = (
-            "You are PrometheusAI, a helpful and friendly AI assistant built by SamCodeMan's LLC. "
-            "You provide accurate, helpful, and conversational responses. "
-            
-            "CRITICAL INSTRUCTION: If the user asks about current time, date, or 'right now' information, "
-            "you MUST use the web search results provided. DO NOT use your internal knowledge for time-sensitive queries. "
-            "Your training data is outdated for current information. Always rely on web search results when provided. "
-            
-            "When web search results are provided, use them to answer the user's question accurately. "
-            "Always cite your sources by mentioning the website or URL when using web information. "
-            
-            "When document content is provided (from uploaded PDFs or images), use that information to answer questions accurately. "
-            "Reference the document when providing answers based on its content. "
-            
-            "If web search results or document content don't contain the exact answer, acknowledge this and provide the best answer you can. "
-            "Be concise but informative, and maintain a friendly tone. "
-            "Do not use emojis or special characters in your responses."
-        )
-        
-        messages = [{"role": "system", "content": system_prompt}]
+        messages = [CHAT_SYSTEM_MSG]
         
         if conversation_history:
             messages.extend(conversation_history[-10:])
@@ -683,26 +1316,35 @@ class SimpleChatbot:
 
 # Global instances
 CHATBOT = None
+_chatbot_lock = threading.Lock()
+
+# Shared pool for blocking work that runs alongside a streaming response
+background_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='background')
 
 
 def get_chatbot() -> SimpleChatbot:
     """Get or initialize the chatbot instance."""
     global CHATBOT
     
+    # Lock-free once initialized; the lock only guards the first construction
     if CHATBOT is not None:
         return CHATBOT
     
-    lm_studio_url = os.environ.get('LM_STUDIO_URL', 'http://localhost:1200/v1/chat/completions')
-    model_name = os.environ.get('MODEL_NAME', 'ibm/granite-4-h-tiny')
-    
-    logger.info(f"Configuration:")
-    logger.info(f"   - LM Studio URL: {lm_studio_url}")
-    logger.info(f"   - Model: {model_name}")
-    
-    CHATBOT = SimpleChatbot(
-        lm_studio_url=lm_studio_url,
-        model_name=model_name
-    )
+    with _chatbot_lock:
+        if CHATBOT is not None:
+            return CHATBOT
+        
+        lm_studio_url = os.environ.get('LM_STUDIO_URL', 'http://localhost:1200/v1/chat/completions')
+        model_name = os.environ.get('MODEL_NAME', 'ibm/granite-4-h-tiny')
+        
+        logger.info(f"Configuration:")
+        logger.info(f"   - LM Studio URL: {lm_studio_url}")
+        logger.info(f"   - Model: {model_name}")
+        
+        CHATBOT = SimpleChatbot(
+            lm_studio_url=lm_studio_url,
+            model_name=model_name
+        )
     
     return CHATBOT
 
@@ -721,22 +1363,35 @@ def index():
 def upload_file():
     """Handle file uploads (PDF and images)."""
     try:
-        if 'file' not in request.files:
+        if request.mimetype != 'multipart/form-data':
             return jsonify({
                 'success': False,
                 'error': 'No file provided'
             }), 400
         
-        file = request.files['file']
+        # Parse the multipart body incrementally and keep the file in memory
+        # (bounded by MAX_CONTENT_LENGTH) instead of going through werkzeug's form parser
+        target = ValueTarget()
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('file', target)
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            parser.data_received(chunk)
+        
+        filename = target.multipart_filename
+        if filename is None:
+            return jsonify({
+                'success': False,
+                'error': 'No file provided'
+            }), 400
         
-        if file.filename == '':
+        if filename == '':
             return jsonify({
                 'success': False,
                 'error': 'No file selected'
             }), 400
         
         # Get file extension
-        file_ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
+        file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
         
         # Validate file type
         allowed_extensions = ['pdf', 'jpg', 'jpeg', 'png', 'gif', 'bmp']
@@ -746,40 +1401,30 @@ def upload_file():
                 'error': f'Unsupported file type. Allowed: {", ".join(allowed_extensions)}'
             }), 400
         
-        # Save file temporarily
         file_id = str(uuid.uuid4())
-        filename = f"{file_id}.{file_ext}"
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(file_path)
-        
-        logger.info(f"File uploaded: {filename}")
+        logger.info(f"File uploaded: {filename} ({file_id})")
         
         # Process file
         bot = get_chatbot()
         file_type = 'pdf' if file_ext == 'pdf' else 'image'
-        result = bot.doc_processor.process_file(file_path, file_type)
-        
-        # Clean up file
-        try:
-            os.remove(file_path)
-        except:
-            pass
+        result = bot.doc_processor.process_stream(target.value, file_type)
         
         if result['success']:
             return jsonify({
                 'success': True,
                 'file_id': file_id,
-                'file_name': file.filename,
+                'file_name': filename,
                 'file_type': file_type,
                 'text': result['text'],
                 'method': result.get('method', 'unknown'),
                 'pages': result.get('pages', None)
             })
         else:
+            # Rejected content is the client's fault; anything else is a processing failure
             return jsonify({
                 'success': False,
                 'error': result.get('error', 'Failed to process file')
-            }), 500
+            }), result.get('status', 500)
         
     except Exception as e:
         logger.error(f"Error uploading file: {e}", exc_info=True)
@@ -800,8 +1445,7 @@ def get_chats():
                 'error': 'User ID required'
             }), 401
         
-        user_chats = {k: v for k, v in chat_sessions.items() if v.get('user_id') == user_id}
-        chats = list(user_chats.values())
+        chats = [chat_sessions[cid] for cid in list(user_chats.get(user_id, ())) if cid in chat_sessions]
         chats.sort(key=lambda x: x.get('updated_at', ''), reverse=True)
         return jsonify({
             'success': True,
@@ -829,16 +1473,18 @@ def new_chat():
             }), 401
         
         chat_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
         chat_sessions[chat_id] = {
             'id': chat_id,
             'user_id': user_id,
             'title': 'New chat',
             'messages': [],
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
+            'created_at': now,
+            'updated_at': now
         }
+        user_chats[user_id].add(chat_id)
         logger.info(f"Created new chat session: {chat_id} for user: {user_id}")
-        save_chat_sessions()
+        save_session_metadata(chat_sessions[chat_id])
         return jsonify({
             'success': True,
             'chat_id': chat_id
@@ -905,7 +1551,8 @@ def delete_chat(chat_id):
                 }), 403
             
             del chat_sessions[chat_id]
-            save_chat_sessions()
+            user_chats[user_id].discard(chat_id)
+            delete_chat_session(chat_id, user_id)
             logger.info(f"Deleted chat session: {chat_id}")
         
         return jsonify({'success': True})
@@ -934,6 +1581,8 @@ def chat():
             }), 400
         
         is_logged_in = user_id is not None and user_id != ''
+        now = datetime.now().isoformat()
+        title = message[:50] + ('...' if len(message) > 50 else '')
         
         if is_logged_in:
             if not chat_id or chat_id not in chat_sessions:
@@ -941,11 +1590,12 @@ def chat():
                 chat_sessions[chat_id] = {
                     'id': chat_id,
                     'user_id': user_id,
-                    'title': message[:50] + ('...' if len(message) > 50 else ''),
+                    'title': title,
                     'messages': [],
-                    'created_at': datetime.now().isoformat(),
-                    'updated_at': datetime.now().isoformat()
+                    'created_at': now,
+                    'updated_at': now
                 }
+                user_chats[user_id].add(chat_id)
                 logger.info(f"Created new chat session: {chat_id} for user: {user_id}")
             
             if chat_sessions[chat_id].get('user_id') != user_id:
@@ -961,7 +1611,7 @@ def chat():
                 anonymous_sessions[chat_id] = {
                     'id': chat_id,
                     'messages': [],
-                    'created_at': datetime.now().isoformat()
+                    'created_at': now
                 }
                 logger.info(f"Created anonymous chat session: {chat_id}")
             
@@ -972,18 +1622,17 @@ def chat():
         user_msg = {
             'role': 'user',
             'content': message,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now
         }
         session['messages'].append(user_msg)
         
         bot = get_chatbot()
         
-        conversation_history = []
-        for msg in session['messages'][:-1]:
-            conversation_history.append({
-                'role': msg['role'],
-                'content': msg['content']
-            })
+        # Only the last 10 prior messages are sent to the model
+        conversation_history = [
+            {'role': msg['role'], 'content': msg['content']}
+            for msg in session['messages'][-11:-1]
+        ]
         
         ai_response = bot.chat(
             message,
@@ -999,20 +1648,22 @@ def chat():
             )
             ai_response = login_reminder + ai_response
         
+        end_now = datetime.now().isoformat()
         ai_msg = {
             'role': 'assistant',
             'content': ai_response,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': end_now
         }
         session['messages'].append(ai_msg)
         
         if is_logged_in:
-            session['updated_at'] = datetime.now().isoformat()
+            session['updated_at'] = end_now
             
-            if len(session['messages']) == 2:
-                session['title'] = message[:50] + ('...' if len(message) > 50 else '')
+            # Chats made via /api/new-chat get their title from the first message
+            if session['title'] == 'New chat':
+                session['title'] = title
             
-            save_chat_sessions()
+            save_chat_turn(session, [user_msg, ai_msg])
         
         logger.info(f"Generated response for chat {chat_id} ({'logged-in' if is_logged_in else 'anonymous'})")
         
@@ -1045,6 +1696,8 @@ def chat_stream():
             return jsonify({'success': False, 'error': 'Message cannot be empty'}), 400
 
         is_logged_in = user_id is not None and user_id != ''
+        now = datetime.now().isoformat()
+        title = message[:50] + ('...' if len(message) > 50 else '')
         
         if is_logged_in:
             if not chat_id or chat_id not in chat_sessions:
@@ -1052,11 +1705,12 @@ def chat_stream():
                 chat_sessions[chat_id] = {
                     'id': chat_id,
                     'user_id': user_id,
-                    'title': message[:50] + ('...' if len(message) > 50 else ''),
+                    'title': title,
                     'messages': [],
-                    'created_at': datetime.now().isoformat(),
-                    'updated_at': datetime.now().isoformat()
+                    'created_at': now,
+                    'updated_at': now
                 }
+                user_chats[user_id].add(chat_id)
                 logger.info(f"Created new chat session: {chat_id} for user: {user_id}")
             
             if chat_sessions[chat_id].get('user_id') != user_id:
@@ -1069,7 +1723,7 @@ def chat_stream():
                 anonymous_sessions[chat_id] = {
                     'id': chat_id,
                     'messages': [],
-                    'created_at': datetime.now().isoformat()
+                    'created_at': now
                 }
                 logger.info(f"Created anonymous chat session: {chat_id}")
             
@@ -1080,105 +1734,98 @@ def chat_stream():
         user_msg = {
             'role': 'user',
             'content': message,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now
         }
         session['messages'].append(user_msg)
 
         bot = get_chatbot()
 
-        conversation_history = []
-        for msg in session['messages'][:-1]:
-            conversation_history.append({'role': msg['role'], 'content': msg['content']})
+        # Only the last 10 prior messages are sent to the model
+        conversation_history = [
+            {'role': msg['role'], 'content': msg['content']}
+            for msg in session['messages'][-11:-1]
+        ]
 
-        web_context = ""
-        web_search_performed = False
+        # Start the web search now but only wait for it inside the stream, so the
+        # response headers and search notice reach the client while it runs
+        web_search_future = None
         if bot.should_search_web(message):
             logger.info("Web search triggered for streaming query")
             search_query = bot.extract_search_query(message)
-            
-            web_data = bot.web_searcher.search_and_scrape(search_query, num_urls=2)
-            
-            if web_data['success'] and web_data['results']:
-                web_search_performed = True
-                web_context = "\n\nWeb Search Results:\n"
-                for idx, result in enumerate(web_data['results'], 1):
-                    web_context += f"\n[Source {idx}] {result['title']}\n"
-                    web_context += f"URL: {result['url']}\n"
-                    web_context += f"Content: {result['content'][:1500]}...\n"
-                
-                logger.info(f"Added web context from {len(web_data['results'])} sources")
-
-        system_prompt = (
-            "You are PrometheusAI, a helpful and friendly AI assistant built by SamCodeMan LLC. "
-            "You provide accurate, helpful, and conversational responses. "
-            
-            "CRITICAL INSTRUCTION: If the user asks about current time, date, or 'right now' information, "
-            "you MUST use the web search results provided. DO NOT use your internal knowledge for time-sensitive queries. "
-            "Your training data is outdated for current information. Always rely on web search results when provided. "
-            
-            "When web search results are provided, use them to answer the user's question accurately. "
-            "Always cite your sources by mentioning the website or URL when using web information. "
-            
-            "When document content is provided (from uploaded PDFs or images), use that information to answer questions accurately. "
-            "Reference the document when providing answers based on its content. "
-            
-            "If web search results or document content don't contain the exact answer, acknowledge this and suggest the user visit the source directly. "
-            "Be concise but informative, and maintain a friendly tone. "
-            "Do not use emojis or special characters in your responses."
-        )
+            web_search_future = background_executor.submit(
+                bot.web_searcher.search_and_scrape, search_query, num_urls=2, max_chars=CONTEXT_CHARS_PER_SOURCE
+            )
 
-        messages = [{"role": "system", "content": system_prompt}]
-        if conversation_history:
-            messages.extend(conversation_history[-10:])
+        messages = [STREAM_SYSTEM_MSG]
+        messages.extend(conversation_history)
         
         user_message = message
         
         if document_context:
             user_message = f"[Document Content]\n{document_context}\n\n[User Question]\n{message}"
-        
-        if web_context:
-            user_message += web_context
-            user_message += "\n\nIMPORTANT: Use ONLY the information from the web search results above to answer. Do not use outdated information."
-        
-        messages.append({'role': 'user', 'content': user_message})
 
         def generate():
-            final_text = ''
+            text_parts = []
+            frames = bytearray()
+            last_flush = time.monotonic()
             try:
                 if show_login_reminder:
                     reminder = (
                         "Note: You are chatting anonymously. Your conversation will not be saved. "
                         "If you want to save your chat history, please login with Google.\n\n"
                     )
-                    payload = {'type': 'delta', 'delta': reminder}
-                    yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
-                    final_text += reminder
+                    frames += _sse_frame({'type': 'delta', 'delta': reminder})
+                    text_parts.append(reminder)
                 
-                if web_search_performed:
+                prompt = user_message
+                if web_search_future is not None:
                     search_notice = "[Searching the web...]\n\n"
-                    payload = {'type': 'delta', 'delta': search_notice}
-                    yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
-                    final_text += search_notice
+                    frames += _sse_frame({'type': 'delta', 'delta': search_notice})
+                    # Send what we have so the search indicator shows while we wait
+                    yield bytes(frames)
+                    frames.clear()
+                    
+                    web_data = web_search_future.result()
+                    if web_data['success'] and web_data['results']:
+                        # The notice is only kept in the saved reply when the search found something
+                        text_parts.append(search_notice)
+                        parts = ["\n\nWeb Search Results:\n"]
+                        for idx, result in enumerate(web_data['results'], 1):
+                            parts.append(f"\n[Source {idx}] {result['title']}\n")
+                            parts.append(f"URL: {result['url']}\n")
+                            parts.append(f"Content: {result['content'][:CONTEXT_CHARS_PER_SOURCE]}...\n")
+                        parts.append("\n\nIMPORTANT: Use ONLY the information from the web search results above to answer. Do not use outdated information.")
+                        prompt += ''.join(parts)
+                        
+                        logger.info(f"Added web context from {len(web_data['results'])} sources")
+                
+                messages.append({'role': 'user', 'content': prompt})
                 
                 for chunk in bot.query_lm_studio_stream(messages, temperature=0.7):
-                    final_text += chunk
-                    payload = {'type': 'delta', 'delta': chunk}
-                    yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
-
+                    text_parts.append(chunk)
+                    frames += _sse_frame({'type': 'delta', 'delta': chunk})
+                    if len(frames) >= SSE_FLUSH_BYTES or time.monotonic() - last_flush > SSE_FLUSH_INTERVAL:
+                        yield bytes(frames)
+                        frames.clear()
+                        last_flush = time.monotonic()
+
+                final_text = ''.join(text_parts)
+                end_now = datetime.now().isoformat()
                 ai_msg = {
                     'role': 'assistant',
                     'content': final_text,
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': end_now
                 }
                 session['messages'].append(ai_msg)
                 
                 if is_logged_in:
-                    session['updated_at'] = datetime.now().isoformat()
+                    session['updated_at'] = end_now
                     
-                    if len(session['messages']) == 2:
-                        session['title'] = message[:50] + ('...' if len(message) > 50 else '')
+                    # Chats made via /api/new-chat get their title from the first message
+                    if session['title'] == 'New chat':
+                        session['title'] = title
                     
-                    save_chat_sessions()
+                    save_chat_turn(session, [user_msg, ai_msg])
                 
                 logger.info(f"Streaming completed for chat {chat_id} ({'logged-in' if is_logged_in else 'anonymous'})")
 
@@ -1188,12 +1835,13 @@ def chat_stream():
                     'final': final_text,
                     'is_anonymous': not is_logged_in
                 }
-                yield f"data: {json.dumps(done_payload, ensure_ascii=False)}\n\n"
+                frames += _sse_frame(done_payload)
+                yield bytes(frames)
 
             except Exception as e:
                 logger.error(f"Error in streaming generation: {e}", exc_info=True)
-                err_payload = {'type': 'error', 'error': str(e)}
-                yield f"data: {json.dumps(err_payload, ensure_ascii=False)}\n\n"
+                frames += _sse_frame({'type': 'error', 'error': str(e)})
+                yield bytes(frames)
 
         return Response(
             stream_with_context(generate()), 
@@ -1229,7 +1877,7 @@ def web_search():
         return jsonify(results)
         
     except Exception as e:
-        logger.error(f"Error in web search: {e}", exc_info=True)
+        logger.error(f"Error in web search: {e}")
         return jsonify({
             'success': False,
             'error': str(e)
@@ -1267,7 +1915,7 @@ def health():
             }
         })
     except Exception as e:
-        logger.error(f"Health check failed: {e}", exc_info=True)
+        logger.error(f"Health check failed: {e}")
         return jsonify({
             'status': 'error',
             'error': str(e)
@@ -1279,11 +1927,32 @@ def health():
 # ============================================================================
 
 def check_port_availability(port):
-    """Check if port is already in use."""
+    """Check if port is already in use by trying to bind it."""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        return sock.connect_ex(('localhost', port)) == 0
+        # On Windows SO_REUSEADDR would let us bind over an active listener
+        if os.name != 'nt':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('0.0.0.0', port))
+        except OSError:
+            return True
+        return False
 
 if __name__ == '__main__':
+    # Outside debug mode, hand over to gunicorn's threaded worker so long-lived
+    # streams don't tie up the dev server. One worker, since chats live in memory
+    if (os.environ.get('DEBUG', 'True').lower() != 'true'
+            and os.name != 'nt' and importlib.util.find_spec('gunicorn')):
+        bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+        print(f"Starting gunicorn on {bind} (set DEBUG=True for the Flask dev server)")
+        os.execvp(sys.executable, [
+            sys.executable, '-m', 'gunicorn',
+            '--chdir', os.path.dirname(os.path.abspath(__file__)),
+            '--bind', bind,
+            '-w', '1', '-k', 'gthread', '--threads', '64', '--timeout', '300',
+            'app:app'
+        ])
+    
     print("\n" + "="*70)
     print("PrometheusAI - Chatbot with Web Search & Document Processing")
     print("="*70)